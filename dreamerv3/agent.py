@@ -33,6 +33,15 @@ class Agent(nj.Module):
     configs = yaml.YAML(typ="safe").load(
         (embodied.Path(__file__).parent / "configs.yaml").read()
     )
+    FLIP_TASKS = frozenset(
+        [
+            "dmc_cartpole_swingup",
+            "dmc_acrobot_swingup",
+            "dmc_cup_catch",
+            "dmc_pendulum_swingup",
+        ]
+    )
+    EQUIV_TASKS = FLIP_TASKS | {"dmc_reacher_easy", "dmc_reacher_hard"}
 
     def __init__(self, obs_space, act_space, step, config, key):
         self.config = config
@@ -42,20 +51,10 @@ class Agent(nj.Module):
         grp = None
         cup_catch = False
         if config.rssm.equiv:
-            assert config.task in [
-                "dmc_cartpole_swingup",
-                "dmc_acrobot_swingup",
-                "dmc_reacher_easy",
-                "dmc_reacher_hard",
-                "dmc_cup_catch",
-                "dmc_pendulum_swingup",
-            ], "Only DMC Cartpole Swingup task supports equivariance"
-            if config.task in [
-                "dmc_cartpole_swingup",
-                "dmc_acrobot_swingup",
-                "dmc_cup_catch",
-                "dmc_pendulum_swingup",
-            ]:
+            assert (
+                config.task in self.EQUIV_TASKS
+            ), "Only DMC Cartpole Swingup task supports equivariance"
+            if config.task in self.FLIP_TASKS:
                 grp = jaxutils.GroupHelper(gspace=gspaces.flip2dOnR2)
                 if config.task == "dmc_cup_catch":
                     cup_catch = True
@@ -73,7 +72,8 @@ class Agent(nj.Module):
             cup_catch=cup_catch,
             key=wm_key,
         )
-        self.task_behavior = getattr(behaviors, config.task_behavior)(
+        task_cls = getattr(behaviors, config.task_behavior)
+        self.task_behavior = task_cls(
             self.wm,
             self.act_space,
             self.config,
@@ -85,7 +85,8 @@ class Agent(nj.Module):
         if config.expl_behavior == "None":
             self.expl_behavior = self.task_behavior
         else:
-            self.expl_behavior = getattr(behaviors, config.expl_behavior)(
+            expl_cls = getattr(behaviors, config.expl_behavior)
+            self.expl_behavior = expl_cls(
                 self.wm, self.act_space, self.config, name="expl_behavior"
             )
 
@@ -107,36 +108,28 @@ class Agent(nj.Module):
         latent, _ = self.wm.rssm.obs_step(
             prev_latent, prev_action, embed, obs["is_first"]
         )
-        self.expl_behavior.policy(latent, expl_state)
-        task_outs, task_state = self.task_behavior.policy(latent, task_state)
-        expl_outs, expl_state = self.expl_behavior.policy(latent, expl_state)
+        if mode == "explore":
+            outs, expl_state = self.expl_behavior.policy(latent, expl_state)
+        else:
+            outs, task_state = self.task_behavior.policy(latent, task_state)
         if mode == "eval":
-            outs = task_outs
-            outs["action"] = outs["action"].sample(seed=nj.rng())
-            outs["log_entropy"] = jnp.zeros(outs["action"].shape[:1])
-        elif mode == "explore":
-            outs = expl_outs
-            outs["log_entropy"] = outs["action"].entropy()
             outs["action"] = outs["action"].sample(seed=nj.rng())
-        elif mode == "train":
-            outs = task_outs
+            outs["log_entropy"] = jnp.broadcast_to(
+                jnp.float32(0), outs["action"].shape[:1]
+            )
+        elif mode in ("explore", "train"):
             outs["log_entropy"] = outs["action"].entropy()
             outs["action"] = outs["action"].sample(seed=nj.rng())
         state = ((latent, outs["action"]), task_state, expl_state)
         return outs, state
 
-    def train(self, data, state):
+    def train(self, data, state, with_metrics=True):
         self.config.jax.jit and print("Tracing train function.")
         metrics = {}
         data = self.preprocess(data, swav=self.config.aug.swav)
         if self.config.aug.swav:
-            prev_latent, prev_action = state
-            prev_latent = {
-                k: jnp.concat([v, v], axis=0) for k, v in prev_latent.items()
-            }
-            prev_action = jnp.concat([prev_action, prev_action], axis=0)
-            state = (prev_latent, prev_action)
-        state, wm_outs, mets = self.wm.train(data, state)
+            state = tree_map(lambda x: jnp.concatenate([x, x], 0), state)
+        state, wm_outs, mets = self.wm.train(data, state, with_metrics)
         metrics.update(mets)
         context = {**data, **wm_outs["post"]}
         start = tree_map(lambda x: x.reshape([-1] + list(x.shape[2:])), context)
@@ -150,7 +143,7 @@ class Agent(nj.Module):
             # TODO: we pass on one of the states as a prev state
             # to the next step, ultimately should promote invariance
             # to translation in the obs but not sure about this solution.
-            state = tree_map(lambda x: jnp.split(x, 2, 0)[0], state)
+            state = tree_map(lambda x: x[: len(x) // 2], state)
         return outs, state, metrics
 
     def report(self, data):
@@ -167,18 +160,16 @@ class Agent(nj.Module):
 
     def preprocess(self, obs, swav=False):
         obs = obs.copy()
-        for key, value in obs.items():
-            if key.startswith("log_") or key in ("key",):
-                continue
-            if len(value.shape) > 3 and value.dtype == jnp.uint8:
-                value = jaxutils.cast_to_compute(value) / 255.0
-            else:
-                value = value.astype(jnp.float32)
-            obs[key] = value
+        keys = [k for k in obs if not k.startswith("log_") and k not in ("key",)]
+        isimg = lambda x: len(x.shape) > 3 and x.dtype == jnp.uint8
+        imgs = {k: obs[k] for k in keys if isimg(obs[k])}
+        others = {k: obs[k] for k in keys if k not in imgs}
+        obs.update(tree_map(lambda x: x * (1 / 255), jaxutils.cast_to_compute(imgs)))
+        obs.update(tree_map(lambda x: x.astype(jnp.float32), others))
         obs["cont"] = 1.0 - obs["is_terminal"].astype(jnp.float32)
         # data augmentation
         if swav:
-            obs = {k: jnp.concat([v, v], axis=0) for k, v in obs.items()}
+            obs = tree_map(lambda x: jnp.concatenate([x, x], 0), obs)
             obs["image"] = jaxutils.random_translate(
                 obs["image"], self.config.aug.max_delta
             )
@@ -191,6 +182,11 @@ class WorldModel(nj.Module):
         self.obs_space = obs_space
         self.act_space = act_space["action"]
         self.config = config
+        deter = config.rssm["deter"]
+        if config.rssm["classes"]:
+            stoch = config.rssm["stoch"] * config.rssm["classes"]
+        else:
+            stoch = config.rssm["stoch"]
         shapes = {k: tuple(v.shape) for k, v in obs_space.items()}
         shapes["embed"] = (512,)
         shapes = {k: v for k, v in shapes.items() if not k.startswith("log_")}
@@ -295,12 +291,8 @@ class WorldModel(nj.Module):
             self.heads["decoder"] = nets.MultiDecoder(
                 shapes,
                 decoder_key,
-                deter=config.rssm["deter"],
-                stoch=(
-                    config.rssm["stoch"] * config.rssm["classes"]
-                    if config.rssm["classes"]
-                    else config.rssm["stoch"]
-                ),
+                deter=deter,
+                stoch=stoch,
                 **config.decoder,
                 grp=grp,
                 name="dec",
@@ -308,12 +300,8 @@ class WorldModel(nj.Module):
         if config.reward_head["equiv"]:
             self.heads["reward"] = nets.EquivMLP(
                 (),
-                deter=config.rssm["deter"],
-                stoch=(
-                    config.rssm["stoch"] * config.rssm["classes"]
-                    if config.rssm["classes"]
-                    else config.rssm["stoch"]
-                ),
+                deter=deter,
+                stoch=stoch,
                 key=reward_key,
                 **config.reward_head,
                 grp=grp,
@@ -325,12 +313,8 @@ class WorldModel(nj.Module):
         if config.cont_head["equiv"]:
             self.heads["cont"] = nets.EquivMLP(
                 (),
-                deter=config.rssm["deter"],
-                stoch=(
-                    config.rssm["stoch"] * config.rssm["classes"]
-                    if config.rssm["classes"]
-                    else config.rssm["stoch"]
-                ),
+                deter=deter,
+                stoch=stoch,
                 key=cont_key,
                 **config.cont_head,
                 grp=grp,
@@ -352,14 +336,14 @@ class WorldModel(nj.Module):
         prev_action = jnp.zeros((batch_size, *self.act_space.shape))
         return prev_latent, prev_action
 
-    def train(self, data, state):
+    def train(self, data, state, with_metrics=True):
         modules = [self.rssm, *self.heads.values()]
         if self.config.encoder.cnn not in ["pretrained", "frame_averaging"]:
             modules += [self.encoder]
         if self.config.aug.swav:
             modules += [self._obs_proj]
         mets, (state, outs, metrics) = self.opt(
-            modules, self.loss, data, state, has_aux=True
+            modules, self.loss, data, state, with_metrics=with_metrics, has_aux=True
         )
         metrics.update(mets)
         if self.config.aug.swav:
@@ -370,14 +354,17 @@ class WorldModel(nj.Module):
 
     def ema_proj(self, data):
         embed = self._ema_encoder(data)
-        if self.rssm._equiv:
-            proj = self._ema_obs_proj(embed.reshape([-1] + list(embed.shape[2:])))
-            proj = proj.reshape(embed.shape[:2] + (-1,))
-        else:
-            proj = self._ema_obs_proj(embed)
-        return proj
+        return self._project(self._ema_obs_proj, embed)
 
-    def loss(self, data, state):
+    def _project(self, proj, embed):
+        if not self.rssm._equiv:
+            return proj(embed)
+        # Equivariant projections expect a single batch dimension.
+        B, T = embed.shape[:2]
+        out = proj(embed.reshape((B * T,) + embed.shape[2:]))
+        return out.reshape((B, T, -1))
+
+    def loss(self, data, state, with_metrics=True):
         embed = self.encoder(data)
         if self.config.decoder.mlp_keys == "embed":
             data["embed"] = embed
@@ -390,17 +377,14 @@ class WorldModel(nj.Module):
         )
         dists = {}
         feats = {**post, "embed": embed}
+        feats_sg = sg(feats)
         for name, head in self.heads.items():
-            out = head(feats if name in self.config.grad_heads else sg(feats))
+            out = head(feats if name in self.config.grad_heads else feats_sg)
             out = out if isinstance(out, dict) else {name: out}
             dists.update(out)
         losses = {}
         if self.config.aug.swav:
-            if self.rssm._equiv:
-                obs_proj = self._obs_proj(embed.reshape([-1] + list(embed.shape[2:])))
-                obs_proj = obs_proj.reshape(embed.shape[:2] + (-1,))
-            else:
-                obs_proj = self._obs_proj(embed)
+            obs_proj = self._project(self._obs_proj, embed)
             ema_proj = jax.lax.stop_gradient(self.ema_proj(data))
             losses = self.rssm.proto_loss(
                 post=post, obs_proj=obs_proj, ema_proj=ema_proj
@@ -418,13 +402,14 @@ class WorldModel(nj.Module):
         last_latent = {k: v[:, -1] for k, v in post.items()}
         last_action = data["action"][:, -1]
         state = last_latent, last_action
-        metrics = self._metrics(data, dists, post, prior, losses, model_loss)
+        metrics = {}
+        if with_metrics:
+            metrics = self._metrics(data, dists, post, prior, losses, model_loss)
         return model_loss.mean(), (state, out, metrics)
 
     def imagine(self, policy, start, horizon):
         first_cont = (1.0 - start["is_terminal"]).astype(jnp.float32)
-        keys = list(self.rssm.initial(1).keys())
-        start = {k: v for k, v in start.items() if k in keys}
+        start = {k: start[k] for k in self.rssm.initial_keys()}
         start["action"] = policy(start)
 
         def step(prev, _):
@@ -435,9 +420,12 @@ class WorldModel(nj.Module):
         traj = jaxutils.scan(step, jnp.arange(horizon), start, self.config.imag_unroll)
         traj = {k: jnp.concatenate([start[k][None], v], 0) for k, v in traj.items()}
         cont = self.heads["cont"](traj).mode()
-        traj["cont"] = jnp.concatenate([first_cont[None], cont[1:]], 0)
+        traj["cont"] = jnp.where(jnp.arange(len(cont))[:, None] == 0, first_cont, cont)
         discount = 1 - 1 / self.config.horizon
-        traj["weight"] = jnp.cumprod(discount * traj["cont"], 0) / discount
+        # Equals cumprod(discount * cont) / discount without scanning the constant.
+        steps = jnp.arange(len(traj["cont"]), dtype=jnp.float32)
+        steps = steps.reshape((-1,) + (1,) * (traj["cont"].ndim - 1))
+        traj["weight"] = discount**steps * jnp.cumprod(traj["cont"], 0)
         return traj
 
     def report(self, data):
@@ -468,10 +456,17 @@ class WorldModel(nj.Module):
         metrics = {}
         metrics.update(jaxutils.tensorstats(entropy(prior), "prior_ent"))
         metrics.update(jaxutils.tensorstats(entropy(post), "post_ent"))
-        metrics.update({f"{k}_loss_mean": v.mean() for k, v in losses.items()})
-        metrics.update({f"{k}_loss_std": v.std() for k, v in losses.items()})
-        metrics["model_loss_mean"] = model_loss.mean()
-        metrics["model_loss_std"] = model_loss.std()
+        # Per-step losses share a shape while the SwAV losses are scalars, so
+        # stack each group of equally shaped losses and reduce it at once.
+        groups = {}
+        for k, v in {**losses, "model": model_loss}.items():
+            groups.setdefault(v.shape, {})[k] = v.reshape(-1)
+        for group in groups.values():
+            stacked = jnp.stack(list(group.values()))
+            means, stds = stacked.mean(-1), stacked.std(-1)
+            for k, mean, std in zip(group.keys(), means, stds):
+                metrics[f"{k}_loss_mean"] = mean
+                metrics[f"{k}_loss_std"] = std
         metrics["reward_max_data"] = jnp.abs(data["reward"]).max()
         metrics["reward_max_pred"] = jnp.abs(dists["reward"].mean()).max()
         if "reward" in dists and not self.config.jax.debug_nans:
@@ -493,6 +488,13 @@ class ImagActorCritic(nj.Module):
             assert not scale or key in critics, key
         self.critics = {k: v for k, v in critics.items() if scales[k]}
         self.scales = scales
+        total = sum(scales[k] for k in self.critics)
+        self._weights = {k: scales[k] / total for k in self.critics}
+        deter = config.rssm["deter"]
+        if config.rssm["classes"]:
+            stoch = config.rssm["stoch"] * config.rssm["classes"]
+        else:
+            stoch = config.rssm["stoch"]
         self.act_space = act_space
         self.config = config
         disc = act_space.discrete
@@ -502,14 +504,10 @@ class ImagActorCritic(nj.Module):
             self.actor = nets.EquivMLP(
                 name="actor",
                 invariant=False,
-                deter=config.rssm["deter"],
+                deter=deter,
                 grp=grp,
                 key=actor_key,
-                stoch=(
-                    config.rssm["stoch"] * config.rssm["classes"]
-                    if config.rssm["classes"]
-                    else config.rssm["stoch"]
-                ),
+                stoch=stoch,
                 shape=act_space.shape,
                 **config.actor,
                 cup_catch=self.cup_catch,
@@ -550,19 +548,17 @@ class ImagActorCritic(nj.Module):
 
     def loss(self, traj):
         metrics = {}
-        advs = []
-        total = sum(self.scales[k] for k in self.critics)
+        adv = 0.0
         for key, critic in self.critics.items():
             rew, ret, base = critic.score(traj, self.actor)
             offset, invscale = self.retnorms[key](ret)
             normed_ret = (ret - offset) / invscale
-            normed_base = (base - offset) / invscale
-            advs.append((normed_ret - normed_base) * self.scales[key] / total)
+            # The offset cancels in the difference of normalized values.
+            adv += self._weights[key] * (ret - base) / invscale
             metrics.update(jaxutils.tensorstats(rew, f"{key}_reward"))
             metrics.update(jaxutils.tensorstats(ret, f"{key}_return_raw"))
             metrics.update(jaxutils.tensorstats(normed_ret, f"{key}_return_normed"))
             metrics[f"{key}_return_rate"] = (jnp.abs(ret) >= 0.5).mean()
-        adv = jnp.stack(advs).sum(0)
         policy = self.actor(sg(traj))
         logpi = policy.log_prob(sg(traj["action"]))[:-1]
         loss = {"backprop": -adv, "reinforce": -logpi * sg(adv)}[self.grad]
@@ -575,7 +571,6 @@ class ImagActorCritic(nj.Module):
 
     def _metrics(self, traj, policy, logpi, ent, adv):
         metrics = {}
-        ent = policy.entropy()[:-1]
         rand = (ent - policy.minent) / (policy.maxent - policy.minent)
         rand = rand.mean(range(2, len(rand.shape)))
         act = traj["action"]
@@ -594,16 +589,17 @@ class VFunction(nj.Module):
     def __init__(self, rewfn, config, grp, key):
         self.rewfn = rewfn
         self.config = config
+        deter = config.rssm["deter"]
+        if config.rssm["classes"]:
+            stoch = config.rssm["stoch"] * config.rssm["classes"]
+        else:
+            stoch = config.rssm["stoch"]
         if config.rssm.equiv:
             keys = jax.random.split(key, 2)
             self.net = nets.InvMLP(
                 (),
-                deter=config.rssm["deter"],
-                stoch=(
-                    config.rssm["stoch"] * config.rssm["classes"]
-                    if config.rssm["classes"]
-                    else config.rssm["stoch"]
-                ),
+                deter=deter,
+                stoch=stoch,
                 **self.config.critic,
                 grp=grp,
                 key=keys[0],
@@ -612,12 +608,8 @@ class VFunction(nj.Module):
             )
             self.slow = nets.InvMLP(
                 (),
-                deter=config.rssm["deter"],
-                stoch=(
-                    config.rssm["stoch"] * config.rssm["classes"]
-                    if config.rssm["classes"]
-                    else config.rssm["stoch"]
-                ),
+                deter=deter,
+                stoch=stoch,
                 **self.config.critic,
                 grp=grp,
                 key=keys[1],
@@ -669,9 +661,12 @@ class VFunction(nj.Module):
         discount = 1 - 1 / self.config.horizon
         disc = traj["cont"][1:] * discount
         value = self.net(traj).mean()
-        vals = [value[-1]]
         interm = rew + disc * value[1:] * (1 - self.config.return_lambda)
-        for t in reversed(range(len(disc))):
-            vals.append(interm[t] + disc[t] * self.config.return_lambda * vals[-1])
-        ret = jnp.stack(list(reversed(vals))[:-1])
+
+        def step(carry, inp):
+            d, i = inp
+            carry = i + d * self.config.return_lambda * carry
+            return carry, carry
+
+        _, ret = jax.lax.scan(step, value[-1], (disc, interm), reverse=True)
         return rew, ret, value[:-1]
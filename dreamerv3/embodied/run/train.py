@@ -1,3 +1,4 @@
+import functools
 import re
 
 import embodied
@@ -27,20 +28,24 @@ def train(agent, env, replay, logger, args):
     timer.wrap("logger", logger, ["write"])
 
     nonzeros = set()
+    sum_re = re.compile(args.log_keys_sum)
+    mean_re = re.compile(args.log_keys_mean)
+    max_re = re.compile(args.log_keys_max)
+    matches = {}  # Episode keys repeat, so match each key only once.
 
     def per_episode(ep):
         length = len(ep["reward"]) - 1
-        score = float(ep["reward"].astype(np.float64).sum())
-        sum_abs_reward = float(np.abs(ep["reward"]).astype(np.float64).sum())
-        discounted_score = 0
-        for r in reversed(ep["reward"].tolist()):
-            discounted_score = r + 0.99 * discounted_score
+        rewards = ep["reward"].astype(np.float64)
+        abs_rewards = np.abs(rewards)
+        score = float(rewards.sum())
+        sum_abs_reward = float(abs_rewards.sum())
+        discounted_score = float(rewards @ discounts(len(rewards)))
         logger.add(
             {
                 "length": length,
                 "score": score,
                 "sum_abs_reward": sum_abs_reward,
-                "reward_rate": (np.abs(ep["reward"]) >= 0.5).mean(),
+                "reward_rate": (abs_rewards >= 0.5).mean(),
                 "discounted_score": discounted_score,
             },
             prefix="episode",
@@ -51,14 +56,19 @@ def train(agent, env, replay, logger, args):
             if key in ep:
                 stats[f"policy_{key}"] = ep[key]
         for key, value in ep.items():
-            if not args.log_zeros and key not in nonzeros and (value == 0).all():
+            if not args.log_zeros and key not in nonzeros and not value.any():
                 continue
             nonzeros.add(key)
-            if re.match(args.log_keys_sum, key):
+            if key not in matches:
+                matches[key] = tuple(
+                    bool(pattern.match(key)) for pattern in (sum_re, mean_re, max_re)
+                )
+            is_sum, is_mean, is_max = matches[key]
+            if is_sum:
                 stats[f"sum_{key}"] = ep[key].sum()
-            if re.match(args.log_keys_mean, key):
+            if is_mean:
                 stats[f"mean_{key}"] = ep[key].mean()
-            if re.match(args.log_keys_max, key):
+            if is_max:
                 stats[f"max_{key}"] = ep[key].max(0).mean()
         metrics.add(stats, prefix="stats")
 
@@ -78,12 +88,12 @@ def train(agent, env, replay, logger, args):
         )
     else:
         init_agent = embodied.RandomAgent(env.act_space)
-    while len(replay) < max(args.batch_steps, args.train_fill):
-        driver(
-            init_agent.policy,
-            steps=100,
-            planner=isinstance(init_agent, embodied.ExpertAgent),
-        )
+    # The replay may count items differently from env steps, so top up until
+    # it is full, which usually takes a single driver call.
+    prefill = max(args.batch_steps, args.train_fill)
+    planner = isinstance(init_agent, embodied.ExpertAgent)
+    while len(replay) < prefill:
+        driver(init_agent.policy, steps=prefill - len(replay), planner=planner)
     logger.add(metrics.result())
     logger.write()
 
@@ -133,3 +143,8 @@ def train(agent, env, replay, logger, args):
         if should_save(step):
             checkpoint.save()
     logger.write()
+
+
+@functools.lru_cache(maxsize=32)
+def discounts(length, discount=0.99):
+    return discount ** np.arange(length)
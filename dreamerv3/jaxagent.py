@@ -74,10 +74,13 @@ class JAXAgent(embodied.Agent):
         rng = self._next_rngs(self.train_devices)
         if state is None:
             state, self.varibs = self._init_train(self.varibs, rng, data["is_first"])
-        (outs, state, mets), self.varibs = self._train(self.varibs, rng, data, state)
-        outs = self._convert_outs(outs, self.train_devices)
         self._updates.increment()
-        if self._should_metrics(self._updates):
+        with_metrics = bool(self._should_metrics(self._updates))
+        (outs, state, mets), self.varibs = self._train(
+            self.varibs, rng, data, state, with_metrics=with_metrics
+        )
+        outs = self._convert_outs(outs, self.train_devices)
+        if with_metrics:
             mets = self._convert_mets(mets, self.train_devices)
         else:
             mets = {}
@@ -100,7 +103,7 @@ class JAXAgent(embodied.Agent):
             workers=self.data_loaders,
             postprocess=lambda x: self._convert_inps(x, self.train_devices),
             prefetch_source=4,
-            prefetch_batch=1,
+            prefetch_batch=2,
         )
         return batcher()
 
@@ -154,6 +157,9 @@ class JAXAgent(embodied.Agent):
         jax.config.update("jax_debug_nans", self.config.debug_nans)
         jax.config.update("jax_transfer_guard", "allow")
         jax.config.update("jax_enable_x64", False)
+        if self.config.compilation_cache:
+            path = os.path.expanduser(self.config.compilation_cache)
+            jax.config.update("jax_compilation_cache_dir", path)
         if self.config.platform == "cpu":
             jax.config.update("jax_disable_most_optimizations", self.config.debug)
         jaxutils.COMPUTE_DTYPE = getattr(jnp, self.config.precision)
@@ -167,12 +173,12 @@ class JAXAgent(embodied.Agent):
         if len(self.train_devices) == 1:
             kw = dict(device=self.train_devices[0])
             self._init_train = jax.jit(self._init_train, **kw)
-            self._train = jax.jit(self._train, **kw)
+            self._train = jax.jit(self._train, static_argnames=["with_metrics"], **kw)
             self._report = jax.jit(self._report, **kw)
         else:
             kw = dict(devices=self.train_devices)
             self._init_train = nj.pmap(self._init_train, "i", **kw)
-            self._train = nj.pmap(self._train, "i", **kw)
+            self._train = nj.pmap(self._train, "i", static=["with_metrics"], **kw)
             self._report = nj.pmap(self._report, "i", **kw)
         if len(self.policy_devices) == 1:
             kw = dict(device=self.policy_devices[0])
@@ -234,7 +240,7 @@ class JAXAgent(embodied.Agent):
         data = self._dummy_batch({**obs_space, **act_space}, dims)
         data = self._convert_inps(data, self.train_devices)
         state, varibs = self._init_train(varibs, rng, data["is_first"])
-        _, varibs = self._train(varibs, rng, data, state)
+        _, varibs = self._train(varibs, rng, data, state, with_metrics=True)
         # obs = self._dummy_batch(obs_space, (1,))
         # state, varibs = self._init_policy(varibs, rng, obs['is_first'])
         # varibs = self._policy(
@@ -1,10 +1,11 @@
+import functools
 import re
 
 import jax
 import jax.numpy as jnp
+import numpy as np
 import escnn_jax.nn as nn
 import escnn_jax.gspaces as gspaces
-import augmax
 import optax
 from tensorflow_probability.substrates import jax as tfp
 
@@ -15,37 +16,6 @@ tree_map = jax.tree_util.tree_map
 sg = lambda x: tree_map(jax.lax.stop_gradient, x)
 COMPUTE_DTYPE = jnp.float32
 
-transform = augmax.Chain(augmax.RandomCrop(64, 64))
-
-
-def cosine_distance(vec1, vec2):
-    """
-    Computes the cosine distance between two vectors.
-
-    Args:
-        vec1 (jnp.ndarray): First vector.
-        vec2 (jnp.ndarray): Second vector.
-
-    Returns:
-        float: Cosine distance between vec1 and vec2.
-    """
-    # Compute the dot product
-    dot_product = jnp.dot(vec1, vec2)
-
-    # Compute the magnitudes (L2 norms) of the vectors
-    norm_vec1 = jnp.linalg.norm(vec1)
-    norm_vec2 = jnp.linalg.norm(vec2)
-
-    # Compute the cosine similarity
-    cosine_similarity = dot_product / (
-        norm_vec1 * norm_vec2 + 1e-8
-    )  # Add epsilon to avoid division by zero
-
-    # Cosine distance is 1 - cosine similarity
-    cosine_distance = 1.0 - cosine_similarity
-
-    return cosine_distance
-
 
 def cast_to_compute(values):
     return tree_map(lambda x: x.astype(COMPUTE_DTYPE), values)
@@ -60,12 +30,13 @@ def parallel():
 
 
 def tensorstats(tensor, prefix=None):
+    low, high = tensor.min(), tensor.max()
     metrics = {
         "mean": tensor.mean(),
         "std": tensor.std(),
-        "mag": jnp.abs(tensor).max(),
-        "min": tensor.min(),
-        "max": tensor.max(),
+        "mag": jnp.maximum(-low, high),
+        "min": low,
+        "max": high,
         "dist": subsample(tensor),
     }
     if prefix:
@@ -76,33 +47,27 @@ def tensorstats(tensor, prefix=None):
 def subsample(values, amount=1024):
     values = values.flatten()
     if len(values) > amount:
-        values = jax.random.permutation(nj.rng(), values)[:amount]
+        # Sampling indices with replacement avoids permuting the whole tensor.
+        indices = jax.random.randint(nj.rng(), (amount,), 0, len(values))
+        values = values[indices]
     return values
 
 
 def scan(fn, inputs, start, unroll=True, modify=False):
+    # The step is traced once; unroll=True unrolls it fully when lowering and
+    # an integer sets the number of steps per loop iteration.
     fn2 = lambda carry, inp: (fn(carry, inp),) * 2
-    if not unroll:
-        return nj.scan(fn2, start, inputs, modify=modify)[1]
-    length = len(jax.tree_util.tree_leaves(inputs)[0])
-    carrydef = jax.tree_util.tree_structure(start)
-    carry = start
-    outs = []
-    for index in range(length):
-        carry, out = fn2(carry, tree_map(lambda x: x[index], inputs))
-        flat, treedef = jax.tree_util.tree_flatten(out)
-        assert treedef == carrydef, (treedef, carrydef)
-        outs.append(flat)
-    outs = [jnp.stack([carry[i] for carry in outs], 0) for i in range(len(outs[0]))]
-    return carrydef.unflatten(outs)
+    if unroll is True:
+        unroll = len(jax.tree_util.tree_leaves(inputs)[0])
+    return nj.scan(fn2, start, inputs, unroll=int(unroll) or 1, modify=modify)[1]
 
 
 def symlog(x):
-    return jnp.sign(x) * jnp.log(1 + jnp.abs(x))
+    return jnp.copysign(jnp.log1p(jnp.abs(x)), x)
 
 
 def symexp(x):
-    return jnp.sign(x) * (jnp.exp(jnp.abs(x)) - 1)
+    return jnp.copysign(jnp.expm1(jnp.abs(x)), x)
 
 
 class OneHotDist(tfd.OneHotCategorical):
@@ -133,6 +98,7 @@ class MSEDist:
         self._agg = agg
         self.batch_shape = mode.shape[: len(mode.shape) - dims]
         self.event_shape = mode.shape[len(mode.shape) - dims :]
+        self._scale = 1 / int(np.prod(self.event_shape)) if agg == "mean" else 1
 
     def mode(self):
         return self._mode
@@ -142,18 +108,14 @@ class MSEDist:
 
     def log_prob(self, value):
         assert self._mode.shape == value.shape, (self._mode.shape, value.shape)
-        if self._agg == "mean":
-            distance = (self._mode - value) ** 2
-            loss = distance.mean(self._dims)
-        elif self._agg == "sum":
-            distance = (self._mode - value) ** 2
-            loss = distance.sum(self._dims)
+        if self._agg in ("mean", "sum"):
+            diff = self._mode - value
+            loss = (diff * diff).sum(self._dims)
+            if self._scale != 1:
+                loss = loss * self._scale
         elif self._agg == "cosine":
-            loss = jax.vmap(cosine_distance)(
-                self._mode.reshape((-1,) + self.event_shape),
-                value.reshape((-1,) + self.event_shape),
-            )
-            loss = loss.reshape(self.batch_shape)
+            flat = lambda x: l2_normalize(x.reshape(self.batch_shape + (-1,)))
+            loss = 1.0 - (flat(self._mode) * flat(value)).sum(-1)
         else:
             raise NotImplementedError(self._agg)
         return -loss
@@ -195,6 +157,12 @@ class SymlogDist:
         return -loss
 
 
+@functools.lru_cache(maxsize=8)
+def bins(low, high, num):
+    # Kept in NumPy because arrays created while tracing cannot be cached.
+    return np.linspace(low, high, num, dtype=np.float32)
+
+
 class DiscDist:
 
     def __init__(
@@ -203,7 +171,8 @@ class DiscDist:
         self.logits = logits
         self.probs = jax.nn.softmax(logits)
         self.dims = tuple([-x for x in range(1, dims + 1)])
-        self.bins = jnp.linspace(low, high, logits.shape[-1])
+        self.bins = jnp.asarray(bins(low, high, logits.shape[-1]))
+        self.num_bins = logits.shape[-1]
         self.low = low
         self.high = high
         self.transfwd = transfwd
@@ -219,24 +188,22 @@ class DiscDist:
 
     def log_prob(self, x):
         x = self.transfwd(x)
-        below = (self.bins <= x[..., None]).astype(jnp.int32).sum(-1) - 1
-        above = len(self.bins) - (self.bins > x[..., None]).astype(jnp.int32).sum(-1)
-        below = jnp.clip(below, 0, len(self.bins) - 1)
-        above = jnp.clip(above, 0, len(self.bins) - 1)
+        # Number of bins <= x, so below and above enclose x.
+        index = jnp.searchsorted(self.bins, x, side="right")
+        below = jnp.clip(index - 1, 0, self.num_bins - 1)
+        above = jnp.clip(index, 0, self.num_bins - 1)
         equal = below == above
         dist_to_below = jnp.where(equal, 1, jnp.abs(self.bins[below] - x))
         dist_to_above = jnp.where(equal, 1, jnp.abs(self.bins[above] - x))
         total = dist_to_below + dist_to_above
         weight_below = dist_to_above / total
         weight_above = dist_to_below / total
-        target = (
-            jax.nn.one_hot(below, len(self.bins)) * weight_below[..., None]
-            + jax.nn.one_hot(above, len(self.bins)) * weight_above[..., None]
-        )
         log_pred = self.logits - jax.scipy.special.logsumexp(
             self.logits, -1, keepdims=True
         )
-        return (target * log_pred).sum(-1).sum(self.dims)
+        gather = lambda idx: jnp.take_along_axis(log_pred, idx[..., None], -1)[..., 0]
+        log_prob = weight_below * gather(below) + weight_above * gather(above)
+        return log_prob.sum(self.dims)
 
 
 def video_grid(video):
@@ -433,6 +400,7 @@ class Optimizer(nj.Module):
                 jnp.array, 1e4, jnp.float16, name="grad_scale"
             )
             self.good_steps = nj.Variable(jnp.array, 0, jnp.int32, name="good_steps")
+        self._update = jax.jit(self.opt.update)
 
     def __call__(self, modules, lossfn, *args, has_aux=False, **kwargs):
         def wrapped(*args, **kwargs):
@@ -449,12 +417,13 @@ class Optimizer(nj.Module):
             *args, **kwargs
         )
         if not self.PARAM_COUNTS[self.path]:
-            count = 0
-            for k, v in params.items():
-                if isinstance(v, nn.R2Conv):
-                    count += v.weights.array.size + v.bias.array.size
-                else:
-                    count += sum(x.size for x in jax.tree_leaves(v))
+            # Only count the trainable arrays of R2Conv, not its basis buffers.
+            isconv = lambda x: isinstance(x, nn.R2Conv)
+            size = lambda x: (
+                x.weights.array.size + x.bias.array.size if isconv(x) else x.size
+            )
+            leaves = jax.tree_util.tree_leaves(params, is_leaf=isconv)
+            count = int(sum(size(x) for x in leaves))
             print(f"Optimizer {self.name} has {count:,} variables.")
             self.PARAM_COUNTS[self.path] = count
         if parallel():
@@ -473,7 +442,7 @@ class Optimizer(nj.Module):
                 lambda _: grads["agent/wm/rssm/prototypes"],
                 operand=None,
             )
-        updates, optstate = self.opt.update(grads, optstate, params)
+        updates, optstate = self._update(grads, optstate, params)
         self.put("state", optstate)
         nj.context().update(optax.apply_updates(params, updates))
         norm = optax.global_norm(grads)
@@ -487,9 +456,11 @@ class Optimizer(nj.Module):
         return (metrics, aux) if has_aux else metrics
 
     def _update_scale(self, grads):
-        finite = jnp.array(
-            [jnp.isfinite(x).all() for x in jax.tree_util.tree_leaves(grads)]
-        ).all()
+        finite = jax.tree_util.tree_reduce(
+            jnp.logical_and,
+            tree_map(lambda x: jnp.isfinite(x).all(), grads),
+            jnp.array(True),
+        )
         keep = finite & (self.good_steps.read() < 1000)
         incr = finite & (self.good_steps.read() >= 1000)
         decr = ~finite
@@ -517,32 +488,44 @@ def late_grad_clip(value=1.0):
     return optax.GradientTransformation(init_fn, update_fn)
 
 
-def tree_keys(params, prefix=""):
-    if hasattr(params, "items"):
-        return type(params)(
-            {k: tree_keys(v, prefix + "/" + k.lstrip("/")) for k, v in params.items()}
-        )
-    elif isinstance(params, (tuple, list)):
-        return [tree_keys(x, prefix) for x in params]
-    elif isinstance(params, jnp.ndarray):
-        return prefix
-    else:
-        raise TypeError(type(params))
+def tree_keys(params):
+    # Join dict keys and attribute names with slashes; sequence indices are not
+    # part of the key.
+    def name(entry):
+        if isinstance(entry, jax.tree_util.DictKey):
+            return str(entry.key).lstrip("/")
+        if isinstance(entry, jax.tree_util.GetAttrKey):
+            return entry.name
+        return None
+
+    return jax.tree_util.tree_map_with_path(
+        lambda path, _: "".join(f"/{n}" for n in map(name, path) if n is not None),
+        params,
+    )
 
 
 def polyak_averaging(src, dst, mix):
-    for k, v in src.items():
-        if isinstance(v, nn.EquivariantModule):
-            if isinstance(v, nn.R2Conv):
-                # TODO: need to find a way to do this without modifying the frozen weights
-                dst[k].weights = nn.equinox.ParameterArray(
-                    mix * v.weights.array + (1 - mix) * dst[k].weights.array
-                )
-                dst[k].bias = nn.equinox.ParameterArray(
-                    mix * v.bias.array + (1 - mix) * dst[k].bias.array
-                )
+    # Gather the trainable arrays of all entries so one tree_map mixes them.
+    # Other equivariant modules hold no trainable arrays and are skipped.
+    isconv = lambda v: isinstance(v, nn.R2Conv)
+    arrays = lambda v: (v.weights.array, v.bias.array) if isconv(v) else v
+    keys = [
+        k
+        for k, v in src.items()
+        if isconv(v) or not isinstance(v, nn.EquivariantModule)
+    ]
+    mixed = tree_map(
+        lambda s, d: mix * s + (1 - mix) * d,
+        {k: arrays(src[k]) for k in keys},
+        {k: arrays(dst[k]) for k in keys},
+    )
+    for k in keys:
+        if isconv(src[k]):
+            # TODO: need to find a way to do this without modifying the frozen weights
+            dst[k].weights = nn.equinox.ParameterArray(mixed[k][0])
+            dst[k].bias = nn.equinox.ParameterArray(mixed[k][1])
         else:
-            dst[k] = tree_map(lambda s, d: mix * s + (1 - mix) * d, v, dst[k])
+            dst[k] = mixed[k]
     return dst
 
 
@@ -588,10 +571,11 @@ class GroupHelper:
 
 
 def random_translate(images, max_delta=3.0):
+    # Crop each sequence from its edge-padded frames at one random offset that
+    # is shared across time.
     shape = images.shape
     assert len(shape) == 5
-    B, _ = shape[:2]
-    keys = nj.rng(B)
+    B, T, H, W, C = shape
     max_delta = int(max_delta)
     padded_img = jnp.pad(
         images,
@@ -604,13 +588,9 @@ def random_translate(images, max_delta=3.0):
         ],
         mode="edge",
     )
-    aug_images = jax.vmap(
-        jax.vmap(
-            transform, in_axes=(None, 0)
-        ),  # Inner vmap over time dim `padded_img` only
-        in_axes=(0, 0),  # Outer vmap over `keys` and batch dim `padded_img`
-    )(keys, padded_img)
-    return jnp.reshape(aug_images, shape)
+    offsets = jax.random.randint(nj.rng(), (2, B), 0, 2 * max_delta + 1)
+    crop = lambda x, i, j: jax.lax.dynamic_slice(x, (0, i, j, 0), (T, H, W, C))
+    return jax.vmap(crop)(padded_img, offsets[0], offsets[1])
 
 
 def l2_normalize(vectors, axis=-1, epsilon=1e-9):
@@ -619,5 +599,5 @@ def l2_normalize(vectors, axis=-1, epsilon=1e-9):
         vectors: Input array of shape (..., D), where D is the dimension of the vectors.
         axis: Axis along which to normalize. Default is -1 (last axis).
         epsilon: Small value to avoid division by zero."""
-    norms = jnp.linalg.norm(vectors, axis=axis, ord=2, keepdims=True)
-    return vectors / jnp.maximum(norms, epsilon)
+    sqrs = jnp.square(vectors).sum(axis=axis, keepdims=True)
+    return vectors * jax.lax.rsqrt(jnp.maximum(sqrs, epsilon**2))
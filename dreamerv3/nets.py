@@ -195,6 +195,11 @@ class RSSM(nj.Module):
         }
         self.init_gru_cell = nn.R2Conv(**gru_kw)
 
+    def initial_keys(self):
+        if self._classes:
+            return ("deter", "logit", "stoch")
+        return ("mean", "std", "stoch", "deter")
+
     def initial(self, bs):
         if self._equiv:
             stoch = int(self._stoch // self._grp.scaler**0.5 * self._grp.scaler)